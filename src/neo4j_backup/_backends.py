@@ -1,46 +1,165 @@
-from random import choice
-from string import ascii_lowercase
+from re import match
+from math import isfinite
 from json import dumps, loads
-from gzip import open as gzip_open
+from gzip import GzipFile
+from hashlib import blake2b
+from io import DEFAULT_BUFFER_SIZE
+from threading import local
 
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the standard library json module
+    orjson = None
 
-def to_json(file_path, data, compress=False, indent=4):
-    json_string = dumps(data, default=str, indent=indent)
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, fall back to gzip
+    zstandard = None
 
-    if compress:
-        with gzip_open(f"{file_path}.gz", 'wb') as f:
-            f.write(bytes(json_string, 'utf-8'))
+# Strings starting with these represent temporal or spatial values in the backups
+LITERALS = ("$point(", "$date(", "$time(", "$datetime(", "$duration(")
+
+# Larger buffer for the raw compressed files, the default of 8 KiB causes a lot of small reads/writes
+BUFFER_SIZE = DEFAULT_BUFFER_SIZE * 16
+
+# Number of records pulled from Neo4j per round trip while extracting, the driver's default is 1000
+FETCH_SIZE = 50000
+
+# Number of nodes or relationships written to each data file, the same as the Importer's default batch_size
+ROWS_PER_SHARD = 10000
+
+# Compression levels accepted by the codec the data files are compressed with
+COMPRESSLEVELS = range(1, 23) if zstandard is not None else range(1, 10)
+
+# First bytes of a zstandard frame, used to tell zstandard files apart from gzip files
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+# zstandard contexts are expensive to set up but are not thread safe, so each thread keeps and reuses its own
+_zstd_contexts = local()
+
+
+def _zstd_compressor(level):
+    compressors = getattr(_zstd_contexts, "compressors", None)
+    if compressors is None:
+        compressors = _zstd_contexts.compressors = {}
+    if level not in compressors:
+        # threads=-1 spreads the compression of large files across all of the cores
+        compressors[level] = zstandard.ZstdCompressor(level=level, threads=-1)
+    return compressors[level]
+
+
+def _zstd_decompressor():
+    decompressor = getattr(_zstd_contexts, "decompressor", None)
+    if decompressor is None:
+        decompressor = _zstd_contexts.decompressor = zstandard.ZstdDecompressor()
+    return decompressor
+
+
+def _has_non_finite(data):
+    # Whether data holds a NaN or Infinity float anywhere
+    data_type = type(data)
+    if data_type is float:
+        return not isfinite(data)
+    if data_type is dict:
+        return any(map(_has_non_finite, data.values()))
+    if data_type is list or data_type is tuple:
+        return any(map(_has_non_finite, data))
+    return False
+
+
+def _dumps(data, indent, non_finite=None):
+    # Serialize data straight to utf-8 bytes, orjson can only write compact json or json indented by 2 spaces
+    if orjson is not None and indent in (None, 0, 2):
+
+        # orjson silently writes NaN and Infinity as null, so data holding them is left to the json module
+        if non_finite is None:
+            non_finite = _has_non_finite(data)
+
+        if not non_finite:
+            option = orjson.OPT_INDENT_2 if indent else 0
+            return orjson.dumps(data, default=str, option=option)
+
+    # Formatted the same way as orjson, so a file only looks different if the indent asked for is different
+    separators = None if indent else (",", ":")
+    return bytes(dumps(data, default=str, indent=indent or None, separators=separators, ensure_ascii=False), 'utf-8')
+
+
+def _loads(json_bytes):
+    if orjson is not None:
+        try:
+            return orjson.loads(json_bytes)
+        except orjson.JSONDecodeError:
+            # orjson rejects NaN and Infinity, which the json module writes for non-finite floats
+            pass
+    return loads(json_bytes)
+
+
+def to_json(file_path, data, compress=False, indent=4, compresslevel=1, non_finite=None):
+    # non_finite tells whether data holds NaN or Infinity floats, when not known the data is searched for them
+    json_bytes = _dumps(data, indent, non_finite)
+
+    if compress and zstandard is not None:
+        with open(f"{file_path}.zst", 'wb', buffering=BUFFER_SIZE) as raw:
+            raw.write(_zstd_compressor(compresslevel).compress(json_bytes))
+
+    elif compress:
+        with open(f"{file_path}.gz", 'wb', buffering=BUFFER_SIZE) as raw:
+            with GzipFile(fileobj=raw, mode='wb', compresslevel=compresslevel) as f:
+                f.write(json_bytes)
 
     else:
-        with open(f"{file_path}", "w") as f:
-            f.write(json_string)
+        with open(f"{file_path}", "wb") as f:
+            f.write(json_bytes)
 
 
 def from_json(file_path, compressed=False):
     if compressed:
-        with gzip_open(file_path, 'rb') as f:
-            json_string = f.read()
-        data = loads(json_string)
+        with open(file_path, 'rb', buffering=BUFFER_SIZE) as raw:
+
+            # Backups can be compressed with either zstandard or gzip, check which from the file itself
+            if raw.peek(len(ZSTD_MAGIC))[:len(ZSTD_MAGIC)] == ZSTD_MAGIC:
+                if zstandard is None:
+                    raise ImportError(f"{file_path} is compressed with zstandard, install zstandard to read it")
+                json_bytes = _zstd_decompressor().decompress(raw.read())
+
+            else:
+                with GzipFile(fileobj=raw, mode='rb') as f:
+                    json_bytes = f.read()
 
     else:
-        with open(file_path, "r") as f:
-            json_string = f.read()
-        data = loads(json_string)
+        with open(file_path, "rb") as f:
+            json_bytes = f.read()
 
-    return data
+    return _loads(json_bytes)
 
 
-def get_unique_prop_key(properties):
-    # Generate random string using lowercase ascii letter that is 16 letters long
-    def random_string_generator(str_size, allowed_chars):
-        return ''.join(choice(allowed_chars) for _ in range(str_size))
+def version_tuple(version):
+    # Cast a Neo4j version string such as "5.21.0" or "2025.01.0" to (major, minor)
+    version = match(r"(\d+)\.(\d+)", version)
+    if version is None:
+        return 0, 0
+    return int(version.group(1)), int(version.group(2))
+
 
+def execute_write(session, transaction_function, *args):
+    # execute_write replaced write_transaction in version 5 of the neo4j driver
+    if hasattr(session, "execute_write"):
+        return session.execute_write(transaction_function, *args)
+    return session.write_transaction(transaction_function, *args)
+
+
+def get_unique_prop_key(properties):
     # Cast properties to lowercase
-    properties = [prop.lower() for prop in properties]
+    properties = frozenset(prop.lower() for prop in properties)
+
+    # Derive the key from a hash of the properties, so the same graph always gets the same key
+    digest = blake2b("\n".join(sorted(properties)).encode('utf-8'), digest_size=8).hexdigest()
+    unique_prop_key = f"_bk_{digest}"
 
-    # Keep running until a unique property is found
-    while True:
-        unique_prop_key = random_string_generator(16, ascii_lowercase)
-        if unique_prop_key not in properties:
-            break
+    # A collision is practically impossible, but make sure the key is not an existing property
+    counter = 0
+    while unique_prop_key in properties:
+        counter += 1
+        unique_prop_key = f"_bk_{digest}_{counter}"
     return unique_prop_key
@@ -1,9 +1,12 @@
 from shutil import rmtree
 from pathlib import Path
-from sys import getsizeof
 from os.path import exists
 from os import mkdir, getcwd
+from sys import intern
+from warnings import warn
+from math import isfinite
 from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor
 
 from tqdm import tqdm
 from neo4j import GraphDatabase
@@ -11,14 +14,24 @@ from neo4j.spatial import Point
 from neo4j.time import DateTime, Date, Time, Duration
 from neo4j.exceptions import ServiceUnavailable
 
-from ._backends import to_json, get_unique_prop_key
+from ._backends import LITERALS, FETCH_SIZE, ROWS_PER_SHARD, COMPRESSLEVELS, zstandard, to_json, get_unique_prop_key
+
+# Property values that are written to the backups as they are
+PLAIN_TYPES = frozenset((str, int, float, bool))
+
+# Cypher function that recreates each temporal type
+TEMPORAL_FUNCTIONS = {Date: "date", Time: "time", DateTime: "datetime", Duration: "duration"}
+
+# Coordinate reference system of each point srid
+POINT_CRS = {7203: "cartesian", 9157: "cartesian-3d", 4326: "wgs-84", 4979: "wgs-84-3d"}
 
 
 class Extractor:
 
     def __init__(self, project_dir, driver: GraphDatabase.driver, database: str = "neo4j", input_yes: bool = False,
                  compress: bool = True, indent_size: int = 0, pull_uniqueness_constraints: bool = True,
-                 json_file_size: int = int("0xFFFF", 16)):
+                 json_file_size: int = None, fetch_size: int = FETCH_SIZE, compresslevel: int = 1,
+                 rows_per_shard: int = None):
 
         """
         The purpose of this class is to extract all the information from a neo4j graph
@@ -27,8 +40,15 @@ class Extractor:
         :param driver: Neo4j driver
         :param input_yes: bool, determines weather to just type in "y" for all input options
         :param compress: bool, weather or not to compress files as they are being extracted
-        :param json_file_size: int, max size of json object in memory before dumping
+        :param indent_size: int, number of spaces to indent the data files by, 0 writes them compactly. orjson is
+                            only used for 0 and 2, any other indent is written with the slower json module
+        :param json_file_size: int, deprecated, use rows_per_shard. Size in bytes of the list of rows held in memory
+                               before dumping, each row takes up 8 bytes of the list, so 0xFFFF dumps every 8191 rows
         :param pull_uniqueness_constraints: bool, bool weather or not to extract constraints
+        :param fetch_size: int, number of records pulled from Neo4j per round trip
+        :param compresslevel: int, compression level of the data files, higher is smaller but slower to extract.
+                              1 to 22 when compressing with zstandard, 1 to 9 with gzip
+        :param rows_per_shard: int, number of nodes or relationships written to each data file
         """
 
         self.project_dir: Path = Path(getcwd()) / project_dir
@@ -37,6 +57,12 @@ class Extractor:
         self.database: str = database
         self.input_yes: bool = input_yes
         self.compress: bool = compress
+        self.compresslevel: int = compresslevel
+
+        # Checked here, an invalid level would otherwise only fail on the writer thread after the first file is pulled
+        if compress and compresslevel not in COMPRESSLEVELS:
+            raise ValueError(f"compresslevel must be between {COMPRESSLEVELS[0]} and {COMPRESSLEVELS[-1]} when "
+                             f"compressing with {'gzip' if zstandard is None else 'zstandard'}")
         self.indent_size: int = indent_size
         self.pull_uniqueness_constraints: bool = pull_uniqueness_constraints
 
@@ -46,54 +72,71 @@ class Extractor:
         self.uniqueness_constraints: list = []
         self.db_id: str = ""
 
-        self.node_ids: set = set()
+        self.labels_cache: dict = {}  # Label string of each set of labels seen so far
+        self.node_ids: dict = {}  # Labels of the extracted nodes, keyed by node id
         self.working_extracted_nodes: list = list()
         self.working_extracted_rel: list = list()
+        self.working_nodes_non_finite: bool = False  # Whether the working rows hold NaN or Infinity floats
+        self.working_rel_non_finite: bool = False
         self.node_counter: int = 0
         self.rel_counter: int = 0
+        self.skipped_rels: int = 0  # Relationships left out because an end node is not in the backup
 
         self.uniqueness_constraints_names: list = []
 
-        self.json_file_size: int = json_file_size  # Default size of json objects in memory
+        # json_file_size used to be checked against getsizeof of the list of rows, use the row count it stood for
+        if rows_per_shard is None:
+            rows_per_shard = ROWS_PER_SHARD if json_file_size is None else max(1, json_file_size // 8)
+        self.rows_per_shard: int = rows_per_shard
+        self.fetch_size: int = fetch_size
+
+        self.writer: ThreadPoolExecutor = None
+        self.pending_write = None  # Future of the data file currently being written
 
     def extract_data(self):
 
         # Extracts data
 
-        self._test_connection()
-        self._verify_db_not_empty()
+        self._preflight()  # Make sure the database can be reached and is not empty
 
-        self._pull_db_id()  # Get ID of database
+        # Data files are written from a background thread, so pulling from Neo4j does not stall on compressing them
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            self.writer = writer
 
-        if exists(self.project_dir):
+            # A single session is shared by all the queries used to pull the data
+            with self.driver.session(database=self.database, fetch_size=self.fetch_size) as session:
 
-            if self.input_yes:
-                rmtree(self.project_dir)
+                self._pull_db_id(session)  # Get ID of database
 
-            else:
-                user_input = input(f"The directory {self.project_dir} already exist, would you like to replace the "
-                                   f"directory? (y/N)\n")
-                if user_input.lower() == "y":
-                    rmtree(self.project_dir)
-                else:
-                    raise UserWarning("Aborted, project_dir directory already exists")
-
-        mkdir(self.project_dir)
-        mkdir(self.data_dir)
-
-        if self.pull_uniqueness_constraints:
-            self._pull_constraints()  # get constraints of database
-
-        self._pull_relationships()  # get relationship in database
-        self._pull_lonely_nodes()  # get nodes that are lonely in database
-
-        # dump and compress remaining data
-        if self.working_extracted_nodes:
-            to_json(self.data_dir / f"nodes_{self.node_counter}.json", self.working_extracted_nodes, compress=self.compress,
-                    indent=self.indent_size)
-        if self.working_extracted_rel:
-            to_json(self.data_dir / f"relationships_{self.rel_counter}.json", self.working_extracted_rel, compress=self.compress,
-                    indent=self.indent_size)
+                if exists(self.project_dir):
+
+                    if self.input_yes:
+                        rmtree(self.project_dir)
+
+                    else:
+                        user_input = input(f"The directory {self.project_dir} already exist, would you like to "
+                                           f"replace the directory? (y/N)\n")
+                        if user_input.lower() == "y":
+                            rmtree(self.project_dir)
+                        else:
+                            raise UserWarning("Aborted, project_dir directory already exists")
+
+                mkdir(self.project_dir)
+                mkdir(self.data_dir)
+
+                if self.pull_uniqueness_constraints:
+                    self._pull_constraints(session)  # get constraints of database
+
+                self._pull_nodes(session)  # get nodes in database
+                self._pull_relationships(session)  # get relationship in database
+
+            # dump and compress remaining data
+            if self.working_extracted_nodes:
+                self._dump_nodes()
+            if self.working_extracted_rel:
+                self._dump_rels()
+
+            self._wait_for_write()
 
         # calculate a unique prop key to act a dummy id prop for importing
         unique_prop_key = self._calc_unique_prop_key()
@@ -107,83 +150,75 @@ class Extractor:
         to_json(file_path=self.project_dir / "rel_types.json", data=list(self.rel_types))
         to_json(file_path=self.project_dir / "compressed.json", data=self.compress)
 
-    def _test_connection(self):
+    def _preflight(self):
+
+        # A single ping both tests the connection and verifies there is data to pull
         try:
             with self.driver.session(database=self.database) as session:
-                session.run("MATCH (a) RETURN a LIMIT 1")
+                record = session.run("MATCH (a) RETURN 1 LIMIT 1").single()
         except ServiceUnavailable:
             raise ServiceUnavailable("Unable to connect to database. If this is a local database, make sure the "
                                      "database is running. If this is a remote database, make sure the correct "
                                      "database is referenced.")
 
-    def _verify_db_not_empty(self):
-        with self.driver.session(database=self.database) as session:
-            results = session.run("MATCH (a) RETURN a LIMIT 1").data()
-            if not results:
-                raise LookupError("There is not data to pull from the database, make sure the correct database is "
-                                  "referenced/running.")
+        if record is None:
+            raise LookupError("There is not data to pull from the database, make sure the correct database is "
+                              "referenced/running.")
 
-    def _pull_db_id(self):
+    def _pull_db_id(self, session):
 
-        with self.driver.session(database=self.database) as session:
-            results = session.run("CALL db.info")
+        self.db_id = session.run("CALL db.info").single()['id']
+
+    def _pull_constraints(self, session):
+
+        # Older verisons
+        try:
+            results = session.run("CALL db.constraints")
             for result in results:
-                self.db_id = dict(result)['id']
-
-    def _pull_constraints(self):
-
-        with self.driver.session(database=self.database) as session:
-
-            # Older verisons
-            try:
-                results = session.run("CALL db.constraints")
-                for result in results:
-
-                    # Get raw constraint string
-                    constraint_description = dict(result)['description']
-
-                    # Verify is uniqueness constraint
-                    if "unique" in constraint_description:
-                        # Get the node label
-                        node_label = constraint_description.split(":")[1]
-                        node_label = node_label.split(")")[0].strip()
-
-                        # Get the node property
-                        node_prop = constraint_description.split(".")[1]
-                        node_prop = node_prop.split(")")[0].strip()
-
-                        constraint_name = dict(result)['name']
-                        constraint = dict(
-                            node_label=node_label,
-                            node_prop=node_prop,
-                            constraint_name=constraint_name,
-                        )
-                        self.uniqueness_constraints.append(constraint)
-                        self.uniqueness_constraints_names.append(constraint_name)
-
-            # Newer verisons
-            except:
-                results = session.run("SHOW CONSTRAINTS")
-                for result in results:
-                    if result["type"] == "UNIQUENESS" and result["entityType"] == "NODE":
-                        constraint_name = result["name"]
-                        for node_label in result["labelsOrTypes"]:
-                            for node_prop in result["properties"]:
-                                constraint = dict(
-                                    node_label=node_label,
-                                    node_prop=node_prop,
-                                    constraint_name=constraint_name,
-                                )
-                                self.uniqueness_constraints.append(constraint)
-                                self.uniqueness_constraints_names.append(constraint_name)
+
+                # Get raw constraint string
+                constraint_description = result['description']
+
+                # Verify is uniqueness constraint
+                if "unique" in constraint_description:
+                    # Get the node label
+                    node_label = constraint_description.split(":")[1]
+                    node_label = node_label.split(")")[0].strip()
+
+                    # Get the node property
+                    node_prop = constraint_description.split(".")[1]
+                    node_prop = node_prop.split(")")[0].strip()
+
+                    constraint_name = result['name']
+                    constraint = dict(
+                        node_label=node_label,
+                        node_prop=node_prop,
+                        constraint_name=constraint_name,
+                    )
+                    self.uniqueness_constraints.append(constraint)
+                    self.uniqueness_constraints_names.append(constraint_name)
+
+        # Newer verisons
+        except:
+            results = session.run("SHOW CONSTRAINTS")
+            for result in results:
+                if result["type"] == "UNIQUENESS" and result["entityType"] == "NODE":
+                    constraint_name = result["name"]
+                    for node_label in result["labelsOrTypes"]:
+                        for node_prop in result["properties"]:
+                            constraint = dict(
+                                node_label=node_label,
+                                node_prop=node_prop,
+                                constraint_name=constraint_name,
+                            )
+                            self.uniqueness_constraints.append(constraint)
+                            self.uniqueness_constraints_names.append(constraint_name)
 
     @staticmethod
     def __hash_props(props):
-        literals = ["$point(", "$date(", "$time(", "$datetime(", "$duration("]
-
         hash_props = {}
         for prop_key, prop_value in props.items():
-            if isinstance(prop_value, str) and any(prop_value.startswith(s) for s in literals):
+            if isinstance(prop_value, str) and prop_value.startswith(LITERALS):
                 prop_hash = sha256(prop_value.encode('utf-8')).hexdigest()
                 hash_props[prop_key] = prop_value
                 props[prop_key] = prop_hash
@@ -193,33 +228,35 @@ class Extractor:
     @staticmethod
     def __parse_props(props):
 
+        # Noted while parsing, so the data files do not have to be searched for NaN and Infinity when written
+        non_finite = False
+
         # Custom Parser
         def __parse_prop(prop):
+            nonlocal non_finite
+            prop_type = type(prop)
 
-            # Treat points seperately
-            if isinstance(prop, Point):
-                point_srid = prop.srid
-                prop = list(prop)
-                if point_srid == 7203:
-                    prop = f"$point({'{'}x: {prop[0]}, y: {prop[1]}, crs: 'cartesian'{'}'})"
-                elif point_srid == 9157:
-                    prop = f"$point({'{'}x: {prop[0]}, y: {prop[1]}, z: {prop[2]}, crs: 'cartesian-3d'{'}'})"
-                elif point_srid == 4326:
-                    prop = f"$point({'{'}x: {prop[0]}, y: {prop[1]}, crs: 'wgs-84'{'}'})"
-                elif point_srid == 4979:
-                    prop = f"$point({'{'}x: {prop[0]}, y: {prop[1]}, z: {prop[2]}, crs: 'wgs-84-3d'{'}'})"
-                else:
-                    raise ValueError(f"Point of srid {point_srid} is not supported")
+            # Most values are plain json types, which are stored as is
+            if prop_type in PLAIN_TYPES:
+                if prop_type is float and not isfinite(prop):
+                    non_finite = True
+                return prop
 
             # Treat temporal values seperately
-            elif isinstance(prop, Date):
-                prop = f"$date('{prop.iso_format()}')"
-            elif isinstance(prop, Time):
-                prop = f"$time('{prop.iso_format()}')"
-            elif isinstance(prop, DateTime):
-                prop = f"$datetime('{prop.iso_format()}')"
-            elif isinstance(prop, Duration):
-                prop = f"$duration('{prop.iso_format()}')"
+            if prop_type in TEMPORAL_FUNCTIONS:
+                return f"${TEMPORAL_FUNCTIONS[prop_type]}('{prop.iso_format()}')"
+
+            # Treat points seperately, the driver returns subclasses of Point
+            if isinstance(prop, Point):
+                if prop.srid not in POINT_CRS:
+                    raise ValueError(f"Point of srid {prop.srid} is not supported")
+                coordinates = ", ".join(f"{axis}: {value}" for axis, value in zip("xyz", prop))
+                return f"$point({'{'}{coordinates}, crs: '{POINT_CRS[prop.srid]}'{'}'})"
+
+            # Subclasses of the temporal types miss the lookup above
+            for temporal_type, temporal_function in TEMPORAL_FUNCTIONS.items():
+                if isinstance(prop, temporal_type):
+                    return f"${temporal_function}('{prop.iso_format()}')"
 
             # Otherwise, return the prop
             return prop
@@ -228,72 +265,63 @@ class Extractor:
 
             # Treat each item in an array
             if isinstance(prop_value, list):
-                prop_values = []
-                for sub_prop_value in prop_value:
-                    prop_value = __parse_prop(sub_prop_value)
-                    prop_values.append(prop_value)
-                props[prop_key] = prop_values
+                props[prop_key] = [__parse_prop(sub_prop_value) for sub_prop_value in prop_value]
 
             else:
                 prop_value = __parse_prop(prop_value)
                 props[prop_key] = prop_value
 
-        return props
+        return props, non_finite
 
-    def __parse_node__(self, node):
-        # Grab important items from a node object
-        node_id = node.id
-        node_labels = list(node.labels)
-        node_labels = sorted(node_labels, key=str.lower)
-        node_labels = ":".join(node_labels)
-        node_props = dict(node)
-        return node_id, node_labels, node_props
-    
-    def _update_node(self, node):
+    def _update_node(self, node_id, node_labels, node_props):
 
         # Updates the current working nodes
-        node_id, node_labels, node_props = self.__parse_node__(node)
-        
-        # Only update if node does not already updated
-        if node_id not in self.node_ids:
-
-            hash_props, node_props = self.__hash_props(node_props)
-            node_props = self.__parse_props(node_props)
-
-            self.node_counter += 1
 
-            row = {'node_id': node_id, 'node_labels': node_labels,
-                   'node_props': node_props, 'hash_props': hash_props}
+        # Only a handful of distinct sets of labels exist, so only build the label string once for each of them
+        labels_key = frozenset(node_labels)
+        node_labels = self.labels_cache.get(labels_key)
+        if node_labels is None:
+            node_labels = intern(":".join(sorted(labels_key, key=str.lower)))
+            self.labels_cache[labels_key] = node_labels
 
-            self.working_extracted_nodes.append(row)
-
-            self.node_ids.add(node_id)
-            self.property_keys.update(node_props.keys())
             self.labels.add(node_labels)
-
             if ":" in node_labels:
                 for node_label in node_labels.split(":"):
                     self.labels.add(node_label)
 
-            size_in_ram = getsizeof(self.working_extracted_nodes)
-            if size_in_ram > self.json_file_size:
-                to_json(self.data_dir / f"nodes_{self.node_counter}.json", self.working_extracted_nodes, compress=self.compress,
-                        indent=self.indent_size)
-                self.working_extracted_nodes = []
+        hash_props, node_props = self.__hash_props(node_props)
+        node_props, non_finite = self.__parse_props(node_props)
+        self.working_nodes_non_finite |= non_finite
+
+        self.node_counter += 1
+
+        row = {'node_id': node_id, 'node_labels': node_labels,
+               'node_props': node_props, 'hash_props': hash_props}
+
+        self.working_extracted_nodes.append(row)
+
+        self.node_ids[node_id] = node_labels
+
+        if len(self.working_extracted_nodes) >= self.rows_per_shard:
+            self._dump_nodes()
 
-    def _update_rel(self, rel, start_node, end_node):
-        # Gather relationship
-        rel_type = rel.type
-        rel_props = dict(rel)
-        hash_props, rel_props = self.__hash_props(rel_props)
-        rel_props = self.__parse_props(rel_props)
+    def _update_rel(self, rel_type, rel_props, start_node_id, end_node_id, start_node_labels, end_node_labels):
+        rel_type = intern(rel_type)
+        hash_props = {}
+
+        # Relationships often have no properties, in which case there is nothing to hash or parse
+        if rel_props:
+            hash_props, rel_props = self.__hash_props(rel_props)
+            rel_props, non_finite = self.__parse_props(rel_props)
+            self.working_rel_non_finite |= non_finite
 
-        self.property_keys.update(rel_props.keys())
         self.rel_types.add(rel_type)
 
         row = {'rel_id': self.rel_counter,
-                'start_node_id': start_node.id,
-                'end_node_id': end_node.id,
+                'start_node_id': start_node_id,
+                'end_node_id': end_node_id,
+                'start_node_labels': start_node_labels,
+                'end_node_labels': end_node_labels,
                 'rel_type': rel_type,
                 'rel_props': rel_props,
                 'hash_props': hash_props}
@@ -301,48 +329,85 @@ class Extractor:
 
         self.rel_counter += 1
 
-        size_in_ram = getsizeof(self.working_extracted_rel)
-        if size_in_ram > self.json_file_size:
-            to_json(self.data_dir / f"relationships_{self.rel_counter}.json", self.working_extracted_rel, compress=self.compress,
-                    indent=self.indent_size)
-            self.working_extracted_rel = []
-    
-    def _pull_relationships(self):
+        if len(self.working_extracted_rel) >= self.rows_per_shard:
+            self._dump_rels()
 
-        query = """
-        MATCH (sn)-[r]->(en)
-        RETURN sn, en, r
-        """
+    def _write(self, file_path, data, props_key, non_finite):
+
+        # Wait on the previous file first, so at most one file is held in memory while it is being written
+        self._wait_for_write()
+        self.pending_write = self.writer.submit(self._write_file, file_path, data, props_key, non_finite)
+
+    def _write_file(self, file_path, data, props_key, non_finite):
 
-        with self.driver.session(database=self.database) as session:
-            number_of_relationships = session.run("MATCH p=(sn)-[r]->(en) RETURN COUNT(p)").value()[0]
-            results = session.run(query)
+        # Gather the property keys here rather than for every record, keeps the work off the loop pulling from Neo4j
+        for row in data:
+            self.property_keys.update(row[props_key])
 
-            for record in tqdm(results, total=number_of_relationships,
-                               desc="Extracting Relationships"):
-                start_node = record['sn']
-                end_node = record['en']
-                rel = record["r"]
+        to_json(file_path, data, compress=self.compress, indent=self.indent_size, compresslevel=self.compresslevel,
+                non_finite=non_finite)
 
-                self._update_node(start_node)
-                self._update_node(end_node)
-                self._update_rel(rel, start_node, end_node)
+    def _wait_for_write(self):
+        if self.pending_write is not None:
+            self.pending_write.result()  # Raises any error from writing the file
+            self.pending_write = None
 
-    def _pull_lonely_nodes(self):
+    def _dump_nodes(self):
+        self._write(self.data_dir / f"nodes_{self.node_counter}.json", self.working_extracted_nodes, 'node_props',
+                    self.working_nodes_non_finite)
+        self.working_extracted_nodes = []
+        self.working_nodes_non_finite = False
 
+    def _dump_rels(self):
+        self._write(self.data_dir / f"relationships_{self.rel_counter}.json", self.working_extracted_rel, 'rel_props',
+                    self.working_rel_non_finite)
+        self.working_extracted_rel = []
+        self.working_rel_non_finite = False
+
+    def _pull_nodes(self, session):
+
+        # Only project the fields that are stored, rather than building full node objects
         query = """
         MATCH (n)
-        WHERE NOT EXISTS((n)-[]-())
-        RETURN n
+        RETURN id(n), labels(n), properties(n)
         """
 
-        with self.driver.session(database=self.database) as session:
-            number_of_nodes = session.run(f"MATCH (n) WHERE NOT EXISTS((n)-[]-()) RETURN COUNT(n)").value()[0]
-            results = session.run(query)
-            for record in tqdm(results, total=number_of_nodes, desc="Extracting Lonely Nodes"):
-                # Base node object
-                node = record['n']
-                self._update_node(node)
+        # Counting without labels is answered from Neo4j's count store instead of scanning the graph
+        number_of_nodes = session.run("MATCH (n) RETURN COUNT(n)").value()[0]
+        results = session.run(query)
+
+        for record in tqdm(results, total=number_of_nodes, desc="Extracting Nodes"):
+            node_id, node_labels, node_props = record
+            self._update_node(node_id, node_labels, node_props)
+
+    def _pull_relationships(self, session):
+
+        # Every node was already pulled, so only the ids of the start and end nodes are needed
+        query = """
+        MATCH (sn)-[r]->(en)
+        RETURN id(sn), id(en), type(r), properties(r)
+        """
+
+        # Counting without labels or paths is answered from Neo4j's count store instead of scanning the graph
+        number_of_relationships = session.run("MATCH ()-[r]->() RETURN COUNT(r)").value()[0]
+        results = session.run(query)
+
+        for record in tqdm(results, total=number_of_relationships,
+                           desc="Extracting Relationships"):
+            sn_id, en_id, rel_type, rel_props = record
+
+            # Nodes created after the nodes were pulled are not in the backup, so there is nothing to connect them to
+            start_node_labels = self.node_ids.get(sn_id)
+            end_node_labels = self.node_ids.get(en_id)
+            if start_node_labels is None or end_node_labels is None:
+                self.skipped_rels += 1
+                continue
+
+            self._update_rel(rel_type, rel_props, sn_id, en_id, start_node_labels, end_node_labels)
+
+        if self.skipped_rels:
+            warn(f"Skipped {self.skipped_rels} relationships to nodes that were created after the nodes were "
+                 f"extracted, these relationships are not in the backup", UserWarning)
 
     def _calc_unique_prop_key(self):
         keys_to_avoid = self.property_keys.copy()
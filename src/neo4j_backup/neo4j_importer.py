@@ -1,16 +1,20 @@
 from tqdm import tqdm
 from pathlib import Path
 from os import getcwd
+from sys import intern
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-from neo4j import GraphDatabase
-from neo4j.exceptions import ServiceUnavailable
+from neo4j import GraphDatabase, WRITE_ACCESS
+from neo4j.exceptions import ServiceUnavailable, ClientError
 
-from ._backends import from_json
+from ._backends import LITERALS, FETCH_SIZE, from_json, version_tuple, execute_write
 
 
 class Importer:
 
-    def __init__(self, project_dir, driver: GraphDatabase.driver, database: str = "neo4j", input_yes: bool = False):
+    def __init__(self, project_dir, driver: GraphDatabase.driver, database: str = "neo4j", input_yes: bool = False,
+                 batch_size: int = 10000, max_workers: int = 8, fetch_size: int = FETCH_SIZE):
 
         """
         This purpose of this class is to import the information in the project_dir output from the Extractor class.
@@ -18,6 +22,10 @@ class Importer:
         :param project_dir: The directory where to back up Neo4j Graph
         :param driver: Neo4j driver
         :param input_yes: bool, determines weather to just type in "y" for all input options
+        :param batch_size: int, number of rows committed per transaction when inserting nodes and relationships
+        :param max_workers: int, number of node files that are inserted in parallel, the driver's
+                            max_connection_pool_size should be at least max_workers + 1
+        :param fetch_size: int, number of records pulled from Neo4j per round trip when fixing properties
         """
 
         self.project_dir = Path(getcwd()) / project_dir
@@ -25,24 +33,38 @@ class Importer:
         self.driver: GraphDatabase.driver = driver
         self.database: str = database
         self.input_yes: bool = input_yes
+        self.batch_size: int = batch_size
+        self.max_workers: int = max_workers
+        self.fetch_size: int = fetch_size
+        self.dbms_version: tuple = (0, 0)
+        self.apoc_available: bool = False
 
         self.compressed: bool = from_json(self.project_dir / "compressed.json")
         self.unique_prop_key: str = from_json(self.project_dir / f"unique_prop_key.json")
         self.labels: list = from_json(self.project_dir / 'node_labels.json')
-        self.relationship_types: list = from_json(self.project_dir / 'rel_types.json')
         self.uniqueness_constraints: list = from_json(self.project_dir / 'uniqueness_constraints.json')
 
-        self.relationships_files = []
-        for file_path in self.data_dir.iterdir():
-            if "relationship" in file_path.stem:
-                file_path = self.data_dir / file_path
-                self.relationships_files.append(file_path)
+        # Match on the names the Extractor writes, the suffix depends on how the files were compressed
+        # Relationship files are inserted in the order they were extracted, by the counter in their name
+        self.relationships_files = sorted(self.data_dir.glob("relationships_*.json*"), key=self._file_number)
+        # Node files are inserted in parallel, starting the largest files first keeps workers from idling at the end
+        self.nodes_files = sorted(self.data_dir.glob("nodes_*.json*"),
+                                  key=lambda p: (-p.stat().st_size, self._file_number(p)))
 
-        self.nodes_files = []
-        for file_path in self.data_dir.iterdir():
-            if "node" in file_path.stem:
-                file_path = self.data_dir / file_path
-                self.nodes_files.append(file_path)
+        # Insert queries, keyed by the labels/types they insert
+        self.node_queries: dict = {}
+        self.relationship_queries: dict = {}
+
+        self.node_labels_index: dict = {}  # Only used for backups that do not store labels with relationships
+
+        # Rows with hashed props, kept while inserting so the files do not have to be read again to unhash them
+        self.hashed_nodes: list = []
+        self.hashed_rels: list = []
+
+    @staticmethod
+    def _file_number(file_path):
+        # nodes_12.json.gz -> 12, so that nodes_12 sorts after nodes_9
+        return int(file_path.name.split("_")[1].split(".")[0])
 
     def import_data(self):
 
@@ -53,48 +75,53 @@ class Importer:
         """
 
         self._test_connection()  # Make sure the driver can connect to Neo4j database
-        self._verify_is_new_db()  # Make sure database is empty and not the original database
 
-        self._apply_temp_constraints()  # Apply the dummy constraints
+        # The serial steps share a single session, the parallel node inserts open a session per file
+        with self.driver.session(database=self.database, fetch_size=self.fetch_size) as session:
 
-        # Grab all the labels used for Nodes
-        for file_path in tqdm(self.nodes_files, desc="Inserting Nodes"):
-            self._import_nodes_file(file_path)
+            self._verify_is_new_db(session)  # Make sure database is empty and not the original database
+            self._pull_dbms_version(session)  # Determine which Cypher features the database supports
+            self._check_apoc(session)  # APOC is optional, but inserts nodes and relationships with fewer queries
 
-        # Grab all the relationship types used by relationships
-        for file_path in tqdm(self.relationships_files, desc="Inserting Relationships"):
-            self._import_relationships_file(file_path)
-            self._unhash_rel_file(file_path)
+            self._apply_temp_constraints(session)  # Apply the dummy constraints
 
-        # Remove dummy constraints and properties, add real constraints, fix temporal/spatial values
-        self._fix_node_temporal_spatial_values()
-        self._fix_rel_temporal_spatial_values()
+            # Node files are independent of each other, so insert them in parallel with a session per file
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = executor.map(self._import_nodes_file, self.nodes_files)
+                for _ in tqdm(results, total=len(self.nodes_files), desc="Inserting Nodes"):
+                    pass
 
-        # Fix oddly formatted props that had to be hashed
-        for file_path in tqdm(self.nodes_files, desc="Inserting Nodes"):
-            self._unhash_node_file(file_path)
-        for file_path in tqdm(self.relationships_files, desc="Inserting Relationships"):
-            self._unhash_rel_file(file_path)
+            # Grab all the relationship types used by relationships
+            relationships_data = self._read_files(self.relationships_files)
+            for data in tqdm(relationships_data, total=len(self.relationships_files), desc="Inserting Relationships"):
+                self._import_relationships(session, data)
 
-        self._cleanup()
+            # Remove dummy constraints and properties, add real constraints, fix temporal/spatial values
+            self._fix_node_temporal_spatial_values(session)
+            self._fix_rel_temporal_spatial_values(session)
+
+            # Fix oddly formatted props that had to be hashed
+            self._unhash_nodes(session)
+            self._unhash_rels(session)
+
+            self._cleanup(session)
 
     def _test_connection(self):
         try:
             with self.driver.session(database=self.database) as session:
-                session.run("MATCH (a) RETURN a LIMIT 1")
+                session.run("MATCH (a) RETURN 1 LIMIT 1").consume()
         except ServiceUnavailable:
             raise ServiceUnavailable("Unable to connect to database. If this is a local database, make sure the "
                                      "database is running. If this is a remote database, make sure the correct "
                                      "database is referenced.")
 
-    def _verify_is_new_db(self):
+    def _verify_is_new_db(self, session):
 
-        # Grab ping data
-        with self.driver.session(database=self.database) as session:
-            data = session.run("MATCH (a) RETURN a LIMIT 1").data()
+        # Only check whether a single node exists, without pulling the node itself
+        record = session.run("MATCH (a) RETURN 1 LIMIT 1").single()
 
-        # If ping data is not empty, then the database is not empty
-        if data:
+        # If a record came back, then the database is not empty
+        if record is not None:
 
             if self.input_yes:
                 raise UserWarning("Aborted, database referenced is not empty")
@@ -106,37 +133,123 @@ class Importer:
                 if user_input == "y":
                     raise UserWarning("Aborted, database referenced is not empty")
 
-    @staticmethod
-    def _apply_constraint(session, constraint):
+    def _pull_dbms_version(self, session):
+
+        results = session.run("CALL dbms.components() YIELD name, versions")
+        for result in results:
+            if result["name"] == "Neo4j Kernel":
+                self.dbms_version = version_tuple(result["versions"][0])
+
+    def _check_apoc(self, session):
+
         try:
-            constraint_str = f"""
-            CREATE CONSTRAINT {constraint['constraint_name']} 
-            FOR (n:{constraint['node_label']}) 
-            REQUIRE n.{constraint['node_prop']} IS UNIQUE
+            session.run("RETURN apoc.version()").consume()
+            self.apoc_available = True
+        except ClientError:
+            self.apoc_available = False
+
+    def _run_rows(self, session, query, rows, concurrent=False):
+
+        """
+        Run a query once for each row, batching the rows into separate transactions when the database supports it.
+
+        :param session: Neo4j session
+        :param query: Cypher query that uses a single `row`
+        :param rows: list of rows to insert
+        :param concurrent: bool, weather the batches can safely be committed in parallel
+        :return:
+        """
+
+        # CALL {} IN CONCURRENT TRANSACTIONS was added in 5.21, CALL {} IN TRANSACTIONS in 4.4
+        if concurrent and self.dbms_version >= (5, 21):
+            query = f"""
+            UNWIND $rows as row
+            CALL {{ WITH row {query} }} IN CONCURRENT TRANSACTIONS OF {self.batch_size} ROWS
             """
-            session.run(constraint_str)
+        elif self.dbms_version >= (4, 4):
+            query = f"""
+            UNWIND $rows as row
+            CALL {{ WITH row {query} }} IN TRANSACTIONS OF {self.batch_size} ROWS
+            """
+        else:
+            # Older versions can not batch on the server, so commit the batches from here instead
+            query = f"""
+            UNWIND $rows as row
+            {query}
+            """
+            for i in range(0, len(rows), self.batch_size):
+                execute_write(session, self._write_rows, query, rows[i:i + self.batch_size])
             return
-        except:
-            constraint_str = f"""
+
+        session.run(query, parameters={"rows": rows}).consume()
+
+    @staticmethod
+    def _write_rows(tx, query, rows):
+        tx.run(query, parameters={"rows": rows}).consume()
+
+    @staticmethod
+    def _write_query(tx, query, parameters=None):
+        tx.run(query, parameters=parameters).consume()
+
+    @staticmethod
+    def _write_queries(tx, queries):
+        for query in queries:
+            tx.run(query).consume()
+
+    def _write_in_batches(self, session, queries):
+
+        """
+        Commit queries from a generator in transactions of batch_size queries
+
+        :param session: Neo4j session, must not have a result open that is still being read
+        :param queries: iterable of Cypher queries that take no parameters
+        :return:
+        """
+
+        batch = []
+        for query in queries:
+            batch.append(query)
+            if len(batch) >= self.batch_size:
+                execute_write(session, self._write_queries, batch)
+                batch = []
+        if batch:
+            execute_write(session, self._write_queries, batch)
+
+    def _constraint_query(self, constraint):
+
+        # FOR ... REQUIRE was added in 4.4 and replaced ON ... ASSERT, which was removed in 5.0
+        if self.dbms_version >= (4, 4):
+            return f"""
             CREATE CONSTRAINT {constraint['constraint_name']} 
-            ON (n:{constraint['node_label']}) 
-            ASSERT n.{constraint['node_prop']} IS UNIQUE
+            FOR (n:{constraint['node_label']}) 
+            REQUIRE n.{constraint['node_prop']} IS UNIQUE
             """
-            session.run(constraint_str)
+        return f"""
+        CREATE CONSTRAINT {constraint['constraint_name']} 
+        ON (n:{constraint['node_label']}) 
+        ASSERT n.{constraint['node_prop']} IS UNIQUE
+        """
 
-    def _apply_temp_constraints(self):
+    def _run_schema_queries(self, session, queries, desc):
 
-        with self.driver.session(database=self.database) as session:
+        # Each schema change is committed on its own, so one failing constraint does not roll back the others
+        for query in tqdm(queries, desc=desc):
+            execute_write(session, self._write_query, query)
 
-            # Create dummy constraints on each node label, helps speed up inserting significantly
-            for node_label in tqdm(self.labels, desc='Applying Temporary Constraints'):
-                if ":" not in node_label:
-                    constraint = dict(
-                        node_label=node_label,
-                        node_prop=self.unique_prop_key,
-                        constraint_name=f"{node_label}_{self.unique_prop_key}",
-                    )
-                    self._apply_constraint(session, constraint)
+    def _apply_temp_constraints(self, session):
+
+        # Create dummy constraints on each node label, helps speed up inserting significantly
+        # Unlabeled nodes are stored with the labels "", which a constraint can not be created on
+        queries = []
+        for node_label in self.labels:
+            if node_label and ":" not in node_label:
+                constraint = dict(
+                    node_label=node_label,
+                    node_prop=self.unique_prop_key,
+                    constraint_name=f"{node_label}_{self.unique_prop_key}",
+                )
+                queries.append(self._constraint_query(constraint))
+        self._run_schema_queries(session, queries, 'Applying Temporary Constraints')
 
     def _import_nodes_file(self, file_path):
 
@@ -147,197 +260,325 @@ class Importer:
         :return:
         """
 
-        with self.driver.session(database=self.database) as session:
+        # Node inserts return no records, so nothing needs to be buffered from the server
+        with self.driver.session(database=self.database, default_access_mode=WRITE_ACCESS, fetch_size=-1) as session:
 
             data = from_json(file_path, compressed=self.compressed)
+            self.hashed_nodes.extend([row for row in data if row["hash_props"]])
+
+            if self.apoc_available:
+                # APOC sets the labels from each row, so a single query inserts the nodes of every label
+                self._run_rows(session, self._node_query(None), data, concurrent=True)
+                return
+
+            # Group nodes by their labels in a single pass, only labels present in this file are inserted
+            grouped_data = defaultdict(list)
+            for row in data:
+                grouped_data[row["node_labels"]].append(row)
+
+            for node_labels, filtered_data in grouped_data.items():
+                # Nodes do not depend on each other, so the batches can be committed in parallel
+                self._run_rows(session, self._node_query(node_labels), filtered_data, concurrent=True)
 
-            for node_labels in self.labels:
+    def _node_query(self, node_labels):
 
-                filtered_data = []
-                for row in data:
-                    if row["node_labels"] == node_labels:
-                        filtered_data.append(row)
+        """
+        Build the query that inserts nodes with the given labels, each query is only built once
+
+        :param node_labels: str, labels of the nodes joined by ":", or None to set the labels from each row with APOC
+        :return: Cypher query that inserts a single `row`
+        """
+
+        query = self.node_queries.get(node_labels)
+        if query is None:
 
+            if node_labels is None:
+                query = f"""
+                    WITH row, CASE row["node_labels"] WHEN "" THEN [] ELSE split(row["node_labels"], ":") END AS labels
+                    CALL apoc.create.node(labels, row["node_props"]) YIELD node
+                    SET node.{self.unique_prop_key} = row["node_id"]
+                """
+            else:
+                labels = f":{node_labels}" if node_labels else ""
                 query = f"""
-                    UNWIND $rows as row
-                    CREATE (a:{node_labels})
+                    CREATE (a{labels})
                     SET a.{self.unique_prop_key} = row["node_id"]
                     SET a += row["node_props"]
                 """
 
-                session.run(query, parameters={"rows": filtered_data})
+            self.node_queries[node_labels] = query
+        return query
 
-    def _import_relationships_file(self, file_path):
+    def _build_node_label_index(self):
 
         """
-        Import relationships from relationship files
+        Read through each node file once to map the node ids to their labels
 
-        :param file_path:
-        :return:
+        :return: dict of node_id -> node_labels
         """
 
-        with self.driver.session(database=self.database) as session:
-
+        node_labels_index = {}
+        for file_path in tqdm(self.nodes_files, desc="Indexing Node Labels"):
             data = from_json(file_path, compressed=self.compressed)
+            for row in data:
+                # Only a handful of distinct label strings exist, so share them between nodes
+                node_labels_index[row["node_id"]] = intern(row["node_labels"])
+        return node_labels_index
 
-            for relationship in self.relationship_types:
+    def _read_files(self, file_paths):
 
-                filtered_data = []
-                for row in data:
-                    if row["rel_type"] == relationship:
-                        filtered_data.append(row)
+        """
+        Read data files in a background thread, staying one file ahead of the caller so that decompressing and
+        parsing the next file overlaps with inserting the current one
 
-                query = f"""
-                UNWIND $rows as row
-                MATCH (start_node)
-                    WHERE start_node.{self.unique_prop_key} = row["start_node_id"]
-                MATCH (end_node)
-                    WHERE end_node.{self.unique_prop_key} = row["end_node_id"]
-                CREATE (start_node)-[r:{relationship}]->(end_node)
-                SET r.{self.unique_prop_key} = row["rel_id"]
-                SET r += row["rel_props"]
-                """
+        :param file_paths: list of Path objects pointing to data files
+        :return: generator of the data in each file
+        """
 
-                session.run(query, parameters={"rows": filtered_data})
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(from_json, file_paths[0], self.compressed) if file_paths else None
+            for next_file_path in file_paths[1:]:
+                data = future.result()
+                future = executor.submit(from_json, next_file_path, self.compressed)
+                yield data
+            if future is not None:
+                yield future.result()
 
-    def _fix_node_temporal_spatial_values(self):
+    def _import_relationships(self, session, data):
 
-        literals = ["$point(", "$date(", "$time(", "$datetime(", "$duration("]
+        """
+        Import relationships from a relationship file
 
-        with self.driver.session(database=self.database) as session:
+        :param session: Neo4j session
+        :param data: list of relationship rows read from a relationship file
+        :return:
+        """
 
-            # Fix nodes
-            query = f"""
-            MATCH (n)
-            RETURN n
-            """
+        self.hashed_rels.extend([row for row in data if row["hash_props"]])
+
+        # Group relationships by type and by the labels of the start and end nodes
+        grouped_data = defaultdict(list)
+        for row in data:
+
+            # Older backups do not store the labels of the start and end nodes
+            if "start_node_labels" not in row:
+                if not self.node_labels_index:
+                    self.node_labels_index = self._build_node_label_index()
+                row["start_node_labels"] = self.node_labels_index[row["start_node_id"]]
+                row["end_node_labels"] = self.node_labels_index[row["end_node_id"]]
 
-            # Gather number of nodes
-            number_of_nodes = session.run("MATCH (n) RETURN COUNT(n)").value()[0]
-            results = session.run(query)
+            # APOC sets the relationship type from each row, so only the node labels have to be grouped on
+            rel_type = None if self.apoc_available else row["rel_type"]
+            grouped_data[(rel_type, row["start_node_labels"], row["end_node_labels"])].append(row)
 
-            # Going through all properties in all nodes
-            for record in tqdm(results, total=number_of_nodes, desc="Fixing Temporal/Point Node Properties"):
-                node = record['n']
-                node_props = dict(node)
+        for bucket, filtered_data in grouped_data.items():
+            # Relationships lock their start and end nodes, parallel batches would deadlock on shared nodes
+            self._run_rows(session, self._relationship_query(*bucket), filtered_data)
 
-                # Fast update node properties
-                for prop_key, prop_value in node_props.items():
-                    if isinstance(prop_value, str):
-                        if any(prop_value.startswith(s) for s in literals):
-                            # If property is a spatial or temporal value, update the property
-                            query = f"""
-                            MATCH (n)
-                            WHERE n.{self.unique_prop_key} = {node_props[self.unique_prop_key]}
-                            SET n.{prop_key} = {prop_value[1:]}
-                            """
-                            session.run(query)
+    def _relationship_query(self, relationship, start_node_labels, end_node_labels):
 
-    def _fix_rel_temporal_spatial_values(self):
+        """
+        Build the query that inserts relationships between nodes with the given labels, each query is only built once
+
+        :param relationship: str, relationship type, or None to set the type from each row with APOC
+        :param start_node_labels: str, labels of the start nodes joined by ":"
+        :param end_node_labels: str, labels of the end nodes joined by ":"
+        :return: Cypher query that inserts a single `row`
+        """
 
-        literals = ["$point(", "$date(", "$time(", "$datetime(", "$duration("]
+        key = (relationship, start_node_labels, end_node_labels)
+        query = self.relationship_queries.get(key)
+        if query is None:
 
-        with self.driver.session(database=self.database) as session:
+            # Matching on the labels lets Neo4j use the temporary constraints to look up the nodes
+            start_node_labels = f":{start_node_labels}" if start_node_labels else ""
+            end_node_labels = f":{end_node_labels}" if end_node_labels else ""
+
+            if relationship is None:
+                create = 'CALL apoc.create.relationship(start_node, row["rel_type"], {}, end_node) YIELD rel AS r'
+            else:
+                create = f"CREATE (start_node)-[r:{relationship}]->(end_node)"
 
-            # Fix nodes
             query = f"""
-            MATCH (ns)-[r]-(en)
-            RETURN ns, r, en
+            MATCH (start_node{start_node_labels})
+                WHERE start_node.{self.unique_prop_key} = row["start_node_id"]
+            MATCH (end_node{end_node_labels})
+                WHERE end_node.{self.unique_prop_key} = row["end_node_id"]
+            {create}
+            SET r.{self.unique_prop_key} = row["rel_id"]
+            SET r += row["rel_props"]
             """
 
-            # Gather number of nodes
-            number_of_rels = session.run("MATCH p=()-[r]-() RETURN COUNT(p)").value()[0]
-            results = session.run(query)
-
-            # Going through all properties in all nodes
-            for record in tqdm(results, total=number_of_rels, desc="Fixing Temporal/Point Relationship Properties"):
-                rel = record['r']
-                rel_props = dict(rel)
+            self.relationship_queries[key] = query
+        return query
 
-                start_node = dict(record["ns"])
-                start_node = start_node[self.unique_prop_key]
+    def _fix_node_temporal_spatial_values(self, session):
 
-                end_node = dict(record["en"])
-                end_node = end_node[self.unique_prop_key]
+        # Fix nodes
+        query = f"""
+        MATCH (n)
+        RETURN n
+        """
 
-                # Fast update relationship properties
-                for rel_key, rel_value in rel_props.items():
-                    if isinstance(rel_value, str):
-                        if any(rel_value.startswith(s) for s in literals):
-                            # If property is a spatial or temporal value, update the property
-                            query = f"""
-                            MATCH (ns)-[r]-(en)
+        # Gather number of nodes
+        number_of_nodes = session.run("MATCH (n) RETURN COUNT(n)").value()[0]
+        results = session.run(query)
 
-                            WHERE ns.{self.unique_prop_key} = {start_node}
-                            AND en.{self.unique_prop_key} = {end_node}
+        # The nodes are still being streamed from session, so the updates are committed from a separate session
+        with self.driver.session(database=self.database, default_access_mode=WRITE_ACCESS) as write_session:
+            records = tqdm(results, total=number_of_nodes, desc="Fixing Temporal/Point Node Properties")
+            self._write_in_batches(write_session, self._node_fix_queries(records))
 
-                            SET r.{rel_key} = {rel_value[1:]}
-                            """
-                            session.run(query)
+    def _node_fix_queries(self, records):
 
-    def _unhash_node_file(self, file_path):
-         with self.driver.session(database=self.database) as session:
+        # Going through all properties in all nodes
+        for record in records:
+            node = record['n']
+            node_props = dict(node)
 
-            data = from_json(file_path, compressed=self.compressed)
-            for row in data:
-                if row["hash_props"]:
-                    for prop_key, prop_value in row["hash_props"].items():
-                        node_id = row["node_id"]
+            # Matching on the labels lets Neo4j use the temporary constraints to look up the node
+            node_labels = "".join(f":{node_label}" for node_label in node.labels)
 
+            # Fast update node properties
+            for prop_key, prop_value in node_props.items():
+                if isinstance(prop_value, str):
+                    if prop_value.startswith(LITERALS):
+                        # If property is a spatial or temporal value, update the property
                         query = f"""
-                        MATCH (n)
-                        WHERE n.{self.unique_prop_key} = {node_id}
-                        SET n.{prop_key} = "{prop_value}"
+                        MATCH (n{node_labels})
+                        WHERE n.{self.unique_prop_key} = {node_props[self.unique_prop_key]}
+                        SET n.{prop_key} = {prop_value[1:]}
                         """
-                        session.run(query)
+                        yield query
 
-    def _unhash_rel_file(self, file_path):
-         with self.driver.session(database=self.database) as session:
+    def _fix_rel_temporal_spatial_values(self, session):
 
-            data = from_json(file_path, compressed=self.compressed)
-            for row in data:
-                if row["hash_props"]:
-                    for prop_key, prop_value in row["hash_props"].items():
+        # Fix nodes
+        query = f"""
+        MATCH (ns)-[r]->(en)
+        RETURN ns, r, en
+        """
+
+        # Gather number of nodes
+        number_of_rels = session.run("MATCH ()-[r]->() RETURN COUNT(r)").value()[0]
+        results = session.run(query)
+
+        # The relationships are still being streamed from session, so the updates are committed from a separate session
+        with self.driver.session(database=self.database, default_access_mode=WRITE_ACCESS) as write_session:
+            records = tqdm(results, total=number_of_rels, desc="Fixing Temporal/Point Relationship Properties")
+            self._write_in_batches(write_session, self._rel_fix_queries(records))
 
-                        start_node_id = row["start_node_id"]
-                        end_node_id = row["end_node_id"]
+    def _rel_fix_queries(self, records):
 
+        # Going through all properties in all relationships
+        for record in records:
+            rel = record['r']
+            rel_props = dict(rel)
+
+            start_node = dict(record["ns"])
+            start_node = start_node[self.unique_prop_key]
+            start_node_labels = "".join(f":{node_label}" for node_label in record["ns"].labels)
+
+            end_node = dict(record["en"])
+            end_node = end_node[self.unique_prop_key]
+            end_node_labels = "".join(f":{node_label}" for node_label in record["en"].labels)
+
+            # Fast update relationship properties
+            for rel_key, rel_value in rel_props.items():
+                if isinstance(rel_value, str):
+                    if rel_value.startswith(LITERALS):
+                        # If property is a spatial or temporal value, update the property
                         query = f"""
-                        MATCH (ns)-[r]-(en)
+                        MATCH (ns{start_node_labels})-[r]->(en{end_node_labels})
 
-                        WHERE ns.{self.unique_prop_key} = {start_node_id}
-                        AND en.{self.unique_prop_key} = {end_node_id}
+                        WHERE ns.{self.unique_prop_key} = {start_node}
+                        AND en.{self.unique_prop_key} = {end_node}
+                        AND r.{self.unique_prop_key} = {rel_props[self.unique_prop_key]}
 
-                        SET r.{prop_key} = "{prop_value}"
+                        SET r.{rel_key} = {rel_value[1:]}
                         """
-                        session.run(query)
+                        yield query
 
-    def _cleanup(self):
+    def _unhash_nodes(self, session):
+        for row in tqdm(self.hashed_nodes, desc="Unhashing Node Properties"):
+            for prop_key, prop_value in row["hash_props"].items():
+                node_id = row["node_id"]
+                node_labels = f":{row['node_labels']}" if row["node_labels"] else ""
 
-        with self.driver.session(database=self.database) as session:
+                query = f"""
+                MATCH (n{node_labels})
+                WHERE n.{self.unique_prop_key} = {node_id}
+                SET n.{prop_key} = $prop_value
+                """
+                # Passed as a parameter, so quotes, backslashes and newlines in the value do not need escaping
+                execute_write(session, self._write_query, query, {"prop_value": prop_value})
 
-            # Drop dummy unique property key used for merging nodes
-            query = f"""
-            MATCH (a) WHERE a.{self.unique_prop_key} IS NOT NULL
-            REMOVE a.{self.unique_prop_key}
-            """
-            session.run(query)
+    def _unhash_rels(self, session):
+        for row in tqdm(self.hashed_rels, desc="Unhashing Relationship Properties"):
+            for prop_key, prop_value in row["hash_props"].items():
+
+                start_node_id = row["start_node_id"]
+                end_node_id = row["end_node_id"]
+                start_node_labels = f":{row['start_node_labels']}" if row["start_node_labels"] else ""
+                end_node_labels = f":{row['end_node_labels']}" if row["end_node_labels"] else ""
+
+                query = f"""
+                MATCH (ns{start_node_labels})-[r]->(en{end_node_labels})
+
+                WHERE ns.{self.unique_prop_key} = {start_node_id}
+                AND en.{self.unique_prop_key} = {end_node_id}
+                AND r.{self.unique_prop_key} = {row["rel_id"]}
+
+                SET r.{prop_key} = $prop_value
+                """
+                execute_write(session, self._write_query, query, {"prop_value": prop_value})
+
+    def _remove_unique_prop_key(self, session, pattern, var):
 
-            # Drop dummy unique property key used for match relationships in cleanup
+        """
+        Remove the dummy unique property key from every match of a pattern, in batches of batch_size
+
+        :param session: Neo4j session
+        :param pattern: Cypher pattern to match, such as (a) or ()-[a]->()
+        :param var: variable in the pattern that holds the dummy unique property key
+        :return:
+        """
+
+        # Removing the key from the whole graph in one transaction can exhaust the memory of the database
+        if self.dbms_version >= (4, 4):
             query = f"""
-            MATCH ()-[r]-() WHERE r.{self.unique_prop_key} IS NOT NULL
-            REMOVE r.{self.unique_prop_key}
+            MATCH {pattern} WHERE {var}.{self.unique_prop_key} IS NOT NULL
+            CALL {{ WITH {var} REMOVE {var}.{self.unique_prop_key} }} IN TRANSACTIONS OF {self.batch_size} ROWS
             """
-            session.run(query)
-
-            # Drop dummy constraints used to speed up merging nodes
-            for node_labels in tqdm(self.labels, desc='Removing Temporary Constraints'):
-                if ":" not in node_labels:
-                    constraint = f"DROP CONSTRAINT {node_labels}_{self.unique_prop_key}"
-                    session.run(constraint)
-
-            # Apply real constraints
-            if self.uniqueness_constraints:
-                for constraint in tqdm(self.uniqueness_constraints, desc='Applying Actual Constraints',
-                                       total=len(self.uniqueness_constraints)):
-                    self._apply_constraint(session, constraint)
+            session.run(query).consume()
+            return
+
+        # Older versions can not batch on the server, so remove one batch at a time until none are left
+        query = f"""
+        MATCH {pattern} WHERE {var}.{self.unique_prop_key} IS NOT NULL
+        WITH {var} LIMIT {self.batch_size}
+        REMOVE {var}.{self.unique_prop_key}
+        RETURN COUNT({var})
+        """
+        while session.run(query).single()[0]:
+            pass
+
+    def _cleanup(self, session):
+
+        # Drop dummy unique property key used for merging nodes
+        self._remove_unique_prop_key(session, "(a)", "a")
+
+        # Drop dummy unique property key used for match relationships in cleanup
+        self._remove_unique_prop_key(session, "()-[a]->()", "a")
+
+        # Drop dummy constraints used to speed up merging nodes
+        queries = []
+        for node_labels in self.labels:
+            if node_labels and ":" not in node_labels:
+                queries.append(f"DROP CONSTRAINT {node_labels}_{self.unique_prop_key}")
+        self._run_schema_queries(session, queries, 'Removing Temporary Constraints')
+
+        # Apply real constraints
+        if self.uniqueness_constraints:
+            queries = [self._constraint_query(constraint) for constraint in self.uniqueness_constraints]
+            self._run_schema_queries(session, queries, 'Applying Actual Constraints')
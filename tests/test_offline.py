@@ -0,0 +1,325 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from gzip import open as gzip_open
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps
+from warnings import catch_warnings, simplefilter
+import sys
+
+parent_dir = str(Path(__file__).resolve().parent.parent)
+sys.path.append(parent_dir)
+
+from neo4j.spatial import CartesianPoint, WGS84Point
+from neo4j.time import Date, Time, DateTime, Duration
+
+from src.neo4j_backup import Extractor, Importer
+from src.neo4j_backup._backends import to_json, from_json, version_tuple, get_unique_prop_key, zstandard, orjson
+
+
+class RecordingSession:
+    # Stands in for a Neo4j session, records the queries instead of sending them
+
+    def __init__(self):
+        self.queries = []
+
+    def run(self, query, parameters=None, **kwargs):
+        self.queries.append(" ".join(query.split()))
+        return self
+
+    def consume(self):
+        pass
+
+    def execute_write(self, transaction_function, *args):
+        return transaction_function(self, *args)
+
+
+class RecordsSession:
+    # Stands in for a Neo4j session, answers every query with the same records
+
+    def __init__(self, records):
+        self.records = records
+
+    def run(self, query, parameters=None, **kwargs):
+        return self
+
+    def value(self):
+        return [len(self.records)]
+
+    def __iter__(self):
+        return iter(self.records)
+
+
+def make_importer(project_dir, labels):
+    project_dir = Path(project_dir)
+    (project_dir / "data").mkdir()
+    to_json(project_dir / "compressed.json", True)
+    to_json(project_dir / "unique_prop_key.json", "_bk_test")
+    to_json(project_dir / "node_labels.json", labels)
+    to_json(project_dir / "rel_types.json", [])
+    to_json(project_dir / "uniqueness_constraints.json", [])
+    return Importer(project_dir=project_dir, driver=None, input_yes=True)
+
+
+def test_from_json():
+
+    data = [{"node_id": 0, "node_labels": "Person", "node_props": {"name": "a", "score": float("inf")},
+             "hash_props": {}}]
+
+    with TemporaryDirectory() as project_dir:
+        project_dir = Path(project_dir)
+
+        # Backups made before zstandard and orjson were gzip files written by the json module
+        with gzip_open(project_dir / "legacy.json.gz", "wb") as f:
+            f.write(bytes(dumps(data, indent=4), "utf-8"))
+        assert from_json(project_dir / "legacy.json.gz", compressed=True) == data
+
+        # New backups are compressed with zstandard when it is installed, gzip otherwise
+        to_json(project_dir / "new.json", data, compress=True)
+        file_path = project_dir / ("new.json.zst" if zstandard is not None else "new.json.gz")
+        assert from_json(file_path, compressed=True) == data
+
+        to_json(project_dir / "plain.json", data)
+        assert from_json(project_dir / "plain.json") == data
+
+
+def test_non_finite_floats():
+
+    with TemporaryDirectory() as project_dir:
+        project_dir = Path(project_dir)
+
+        # NaN and Infinity survive the round trip, rather than being written as null
+        data = {"f": float("nan"), "l": [1.0, float("inf")], "s": "nullable"}
+        to_json(project_dir / "non_finite.json", data, indent=0)
+        loaded = from_json(project_dir / "non_finite.json")
+        assert loaded["f"] != loaded["f"] and loaded["l"] == [1.0, float("inf")] and loaded["s"] == "nullable"
+
+        # Strings that contain null are still written by orjson
+        to_json(project_dir / "nullable.json", {"s": "nullable", "n": 1.5}, indent=0)
+        with open(project_dir / "nullable.json", "rb") as f:
+            json_bytes = f.read()
+        if orjson is not None:
+            assert json_bytes == orjson.dumps({"s": "nullable", "n": 1.5})
+
+        # The Extractor notes NaN and Infinity while parsing, instead of searching the rows again
+        extractor = Extractor(project_dir=project_dir, driver=None, input_yes=True, compress=False)
+        extractor._update_node(0, ["Person"], {"score": float("-inf")})
+        assert extractor.working_nodes_non_finite
+        extractor._update_rel("KNOWS", {"weight": 0.5}, 0, 0, "Person", "Person")
+        assert not extractor.working_rel_non_finite
+
+
+def test_indent():
+
+    data = {"labels": ["Person", "Movie"], "props": {"name": "é", "score": 1.5}, "empty": []}
+
+    with TemporaryDirectory() as project_dir:
+        project_dir = Path(project_dir)
+
+        # The indent asked for is used whether or not the data holds NaN or Infinity
+        for indent in (0, 2, 4):
+            to_json(project_dir / "finite.json", data, indent=indent, non_finite=False)
+            to_json(project_dir / "non_finite.json", data, indent=indent, non_finite=True)
+            with open(project_dir / "finite.json", "rb") as f:
+                finite_bytes = f.read()
+            with open(project_dir / "non_finite.json", "rb") as f:
+                assert f.read() == finite_bytes
+            if indent:
+                assert finite_bytes.startswith(b"{\n" + b" " * indent + b'"labels"')
+
+
+def test_parse_props():
+
+    # Expected values are what the parser wrote before it dispatched on type
+    parse_props = Extractor._Extractor__parse_props
+    props = {
+        "int": 1, "float": 1.5, "bool": True, "str": "s",
+        "cartesian": CartesianPoint((1.0, 2.0)),
+        "cartesian_3d": CartesianPoint((1, 2, 3)),
+        "wgs_84": WGS84Point((1.5, 2.5)),
+        "wgs_84_3d": WGS84Point((1, 2, 3.5)),
+        "date": Date(2020, 1, 2),
+        "time": Time(12, 1, 2),
+        "datetime": DateTime(2020, 1, 2, 3, 4, 5),
+        "duration": Duration(days=3, seconds=4),
+        "list": [Date(2020, 1, 1), 2],
+    }
+    parsed_props, non_finite = parse_props(props)
+    assert not non_finite
+    assert parsed_props == {
+        "int": 1, "float": 1.5, "bool": True, "str": "s",
+        "cartesian": "$point({x: 1.0, y: 2.0, crs: 'cartesian'})",
+        "cartesian_3d": "$point({x: 1.0, y: 2.0, z: 3.0, crs: 'cartesian-3d'})",
+        "wgs_84": "$point({x: 1.5, y: 2.5, crs: 'wgs-84'})",
+        "wgs_84_3d": "$point({x: 1.0, y: 2.0, z: 3.5, crs: 'wgs-84-3d'})",
+        "date": "$date('2020-01-02')",
+        "time": "$time('12:01:02.000000000')",
+        "datetime": "$datetime('2020-01-02T03:04:05.000000000')",
+        "duration": "$duration('P3DT4S')",
+        "list": ["$date('2020-01-01')", 2],
+    }
+
+    # Subclasses of the temporal types miss the type lookup, but are still parsed
+    class SubDate(Date):
+        pass
+
+    assert parse_props({"date": SubDate(2020, 1, 2)})[0] == {"date": "$date('2020-01-02')"}
+
+
+def test_version_tuple():
+    assert version_tuple("4.4.0") == (4, 4)
+    assert version_tuple("5.21") == (5, 21)
+    assert version_tuple("2025.01") == (2025, 1)
+    assert version_tuple("2025.01") >= (5, 21)
+    assert version_tuple("4.3.12") < (4, 4)
+    assert version_tuple("dev") == (0, 0)
+
+
+def test_get_unique_prop_key():
+
+    # The same properties always give the same key, regardless of order or case
+    unique_prop_key = get_unique_prop_key(["name", "born", "title"])
+    assert unique_prop_key == get_unique_prop_key(["Title", "name", "BORN"])
+    assert unique_prop_key.startswith("_bk_")
+    assert unique_prop_key != get_unique_prop_key(["name", "born"])
+
+    # The key is never one of the existing properties
+    assert get_unique_prop_key([unique_prop_key, "name", "born", "title"]) != unique_prop_key
+
+
+def test_file_number():
+    file_names = ["relationships_12.json.gz", "relationships_9.json.zst", "relationships_100.json"]
+    file_paths = sorted((Path(file_name) for file_name in file_names), key=Importer._file_number)
+    assert [file_path.name for file_path in file_paths] == ["relationships_9.json.zst", "relationships_12.json.gz",
+                                                           "relationships_100.json"]
+
+
+def test_run_rows():
+
+    with TemporaryDirectory() as project_dir:
+        importer = make_importer(project_dir, ["Person"])
+        importer.batch_size = 2
+        rows = [{"node_id": i, "node_labels": "Person", "node_props": {}} for i in range(5)]
+        node_query = importer._node_query("Person")
+
+        # Older versions commit each batch from the client
+        importer.dbms_version = (4, 3)
+        session = RecordingSession()
+        importer._run_rows(session, node_query, rows, concurrent=True)
+        assert len(session.queries) == 3
+        assert not any("IN TRANSACTIONS" in query for query in session.queries)
+
+        # 4.4 batches on the server, concurrent batches need 5.21
+        importer.dbms_version = (4, 4)
+        session = RecordingSession()
+        importer._run_rows(session, node_query, rows, concurrent=True)
+        assert len(session.queries) == 1
+        assert "} IN TRANSACTIONS OF 2 ROWS" in session.queries[0]
+
+        importer.dbms_version = (5, 21)
+        session = RecordingSession()
+        importer._run_rows(session, node_query, rows, concurrent=True)
+        assert "} IN CONCURRENT TRANSACTIONS OF 2 ROWS" in session.queries[0]
+
+        session = RecordingSession()
+        importer._run_rows(session, node_query, rows)
+        assert "} IN TRANSACTIONS OF 2 ROWS" in session.queries[0]
+
+        # With APOC a single query inserts the nodes of every label
+        session = RecordingSession()
+        importer._run_rows(session, importer._node_query(None), rows, concurrent=True)
+        assert "apoc.create.node(labels" in session.queries[0]
+        assert "IN CONCURRENT TRANSACTIONS" in session.queries[0]
+
+
+def test_rows_per_shard():
+
+    with TemporaryDirectory() as project_dir:
+        extractor = Extractor(project_dir=project_dir, driver=None, input_yes=True, compress=False, rows_per_shard=2)
+        extractor.data_dir.mkdir()
+
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            extractor.writer = writer
+            for node_id in range(5):
+                extractor._update_node(node_id, ["Person"], {"name": str(node_id)})
+            extractor._dump_nodes()
+            extractor._wait_for_write()
+
+        node_files = sorted(extractor.data_dir.glob("nodes_*.json"), key=Importer._file_number)
+        assert [len(from_json(file_path)) for file_path in node_files] == [2, 2, 1]
+
+    # The deprecated json_file_size was the size of the list of rows, 8 bytes per row
+    assert Extractor(project_dir="dump", driver=None, json_file_size=int("0xFF", 16)).rows_per_shard == 31
+    assert Extractor(project_dir="dump", driver=None).rows_per_shard == 10000
+
+
+def test_dangling_relationships():
+
+    with TemporaryDirectory() as project_dir:
+        extractor = Extractor(project_dir=project_dir, driver=None, input_yes=True, compress=False)
+        extractor.node_ids = {0: "Person", 1: ""}
+
+        # Node 2 was created after the nodes were pulled, so its relationships are skipped with a warning
+        records = [(0, 1, "KNOWS", {}), (0, 2, "KNOWS", {}), (2, 1, "KNOWS", {})]
+        with catch_warnings(record=True) as warnings:
+            simplefilter("always")
+            extractor._pull_relationships(RecordsSession(records))
+
+        assert extractor.skipped_rels == 2
+        assert len(warnings) == 1 and "Skipped 2 relationships" in str(warnings[0].message)
+        assert [(row["start_node_id"], row["end_node_id"], row["end_node_labels"])
+                for row in extractor.working_extracted_rel] == [(0, 1, "")]
+
+
+def test_compresslevel():
+
+    # zstandard accepts levels up to 22, gzip only up to 9
+    max_level = 22 if zstandard is not None else 9
+    assert Extractor(project_dir="dump", driver=None, compresslevel=max_level).compresslevel == max_level
+    for compresslevel in (0, max_level + 1):
+        try:
+            Extractor(project_dir="dump", driver=None, compresslevel=compresslevel)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"compresslevel {compresslevel} was accepted")
+
+    # The level does not matter when the files are not compressed
+    Extractor(project_dir="dump", driver=None, compress=False, compresslevel=max_level + 1)
+
+
+def test_unlabeled_nodes():
+
+    with TemporaryDirectory() as project_dir:
+        importer = make_importer(project_dir, ["", "Person", "Actor:Person", "Actor"])
+        importer.dbms_version = (5, 21)
+
+        # No constraint can be created on, or dropped from, the empty label
+        session = RecordingSession()
+        importer._apply_temp_constraints(session)
+        importer._cleanup(session)
+        schema_queries = [query for query in session.queries if "CONSTRAINT" in query]
+        assert len(schema_queries) == 4
+        assert not any("(n:)" in query or "DROP CONSTRAINT _" in query for query in schema_queries)
+
+        # Unlabeled nodes are created without a label
+        assert "CREATE (a) " in " ".join(importer._node_query("").split())
+
+        # APOC is given no labels for unlabeled nodes, rather than [""]
+        apoc_query = " ".join(importer._node_query(None).split())
+        assert 'CASE row["node_labels"] WHEN "" THEN []' in apoc_query
+
+
+if __name__ == "__main__":
+
+    test_from_json()
+    test_non_finite_floats()
+    test_indent()
+    test_parse_props()
+    test_version_tuple()
+    test_get_unique_prop_key()
+    test_file_number()
+    test_run_rows()
+    test_rows_per_shard()
+    test_dangling_relationships()
+    test_compresslevel()
+    test_unlabeled_nodes()